@@ -3,14 +3,20 @@
 import argparse
 import config
 import csv
-import json
+import importlib.util
+import os
+import orjson
 import re
 import requests
-import tabulate
+from requests.adapters import HTTPAdapter
+from operator import itemgetter
 import asyncio
 import websockets
 
-tabulate.PRESERVE_WHITESPACE = True
+try:
+    import re._parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
 
 # Determine the protocol based on TLS configuration
 TLS_S = "s" if config.TLS else ""
@@ -21,6 +27,22 @@ headers = {
     "Content-Type": "application/json",
 }
 
+# Shared HTTP session so connections to Home Assistant are kept alive and reused
+session = requests.Session()
+session.headers.update(headers)
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+# Column headers of the printed table and the CSV files
+TABLE_HEADER = ("Friendly Name", "Current Entity ID", "New Entity ID")
+
+# Input files larger than this are read with pyarrow if it is installed
+PYARROW_MIN_FILE_SIZE = 10 << 20
+
+# Tables with more rows than this are not printed when written to a CSV file
+PRINT_ROW_LIMIT = 500
+
 
 def align_strings(table):
     alignment_char = "."
@@ -28,65 +50,85 @@ def align_strings(table):
     if len(table) == 0:
         return table
 
-    for column in range(len(table[0])):
-        # Get the column data from the table
-        column_data = [row[column] for row in table]
+    # Work on the columns of the table and zip them back into rows at the end
+    columns = list(zip(*table))
+
+    for column, column_data in enumerate(columns):
+        # Split each string once and reuse the parts for measuring and aligning
+        splits = [s.split(alignment_char, 1) for s in column_data]
 
         # Find the maximum length of the first part of the split strings
-        strings_to_align = [s for s in column_data if alignment_char in s]
-        if len(strings_to_align) == 0:
+        prefix_lengths = [len(sp[0]) for sp in splits if len(sp) == 2]
+        if len(prefix_lengths) == 0:
             continue
 
-        max_length = max([len(s.split(alignment_char)[0]) for s in strings_to_align])
+        align_string = f"{{:>{max(prefix_lengths)}}}{alignment_char}{{}}".format
 
-        def align_string(s):
-            s_split = s.split(alignment_char, maxsplit=1)
-            if len(s_split) == 1:
-                return s
-            else:
-                return f"{s_split[0]:>{max_length}}.{s_split[1]}"
-
-        # Create the modified table by replacing the column with aligned strings
-        table = [
-            tuple(
-                align_string(value) if i == column else value
-                for i, value in enumerate(row)
-            )
-            for row in table
+        # Replace the column with aligned strings
+        columns[column] = [
+            align_string(*sp) if len(sp) == 2 else sp[0] for sp in splits
         ]
 
-    return table
+    return list(zip(*columns))
+
+
+def format_table(header, rows):
+    # Format the rows as a GitHub-flavoured Markdown table
+    widths = [max(map(len, column)) for column in zip(header, *rows)]
 
+    def format_row(cells):
+        return "| " + " | ".join(c.ljust(w) for c, w in zip(cells, widths)) + " |"
 
-def list_entities(regex=None):
+    lines = [format_row(header), "|" + "|".join("-" * (w + 2) for w in widths) + "|"]
+    lines.extend(format_row(row) for row in rows)
+    return "\n".join(lines)
+
+
+def required_literal(pattern):
+    # Return the longest literal run every match of the pattern must contain,
+    # so callers can cheaply skip strings before running the full regex
+    if pattern.flags & re.IGNORECASE:
+        return ""
+
+    longest = current = ""
+    for op, av in sre_parse.parse(pattern.pattern, pattern.flags):
+        if op is sre_parse.LITERAL:
+            current += chr(av)
+        else:
+            longest = max(longest, current, key=len)
+            current = ""
+
+    return max(longest, current, key=len)
+
+
+def list_entities(search_pattern=None):
     # API endpoint for retrieving all entities
     api_endpoint = f"http{TLS_S}://{config.HOST}/api/states"
 
     # Send GET request to the API endpoint
-    response = requests.get(api_endpoint, headers=headers)
+    response = session.get(api_endpoint)
 
     # Check if the request was successful
     if response.status_code == 200:
         # Parse the JSON response
-        data = json.loads(response.text)
-
-        # Extract entity IDs and friendly names
+        data = orjson.loads(response.content)
+
+        # Filter the entities if a search pattern is provided and extract
+        # their friendly names and entity IDs in a single pass
+        search = None
+        prefilter = ""
+        if search_pattern is not None:
+            search = search_pattern.search
+            prefilter = required_literal(search_pattern)
         entity_data = [
             (entity["attributes"].get("friendly_name", ""), entity["entity_id"])
             for entity in data
+            if search is None
+            or (prefilter in entity["entity_id"] and search(entity["entity_id"]))
         ]
 
-        # Filter the entity data if regex argument is provided
-        if regex:
-            filtered_entity_data = [
-                (friendly_name, entity_id)
-                for friendly_name, entity_id in entity_data
-                if re.search(regex, entity_id)
-            ]
-            entity_data = filtered_entity_data
-
         # Sort the entity data by friendly name
-        entity_data = sorted(entity_data, key=lambda x: x[0])
+        entity_data.sort(key=itemgetter(0))
 
         # Output the entity data
         return entity_data
@@ -96,23 +138,72 @@ def list_entities(regex=None):
         return []
 
 
+def read_input_file_pyarrow(input_filename):
+    # pyarrow is optional and slow to import, so only import it when needed
+    import pyarrow
+    import pyarrow.csv
+
+    table = pyarrow.csv.read_csv(
+        input_filename,
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={column: pyarrow.string() for column in TABLE_HEADER},
+            strings_can_be_null=False,
+        ),
+    )
+
+    def column_values(column):
+        if column in table.column_names:
+            return table.column(column).to_pylist()
+        return [""] * table.num_rows
+
+    # 'Friendly Name' and 'New Entity ID' are optional
+    return list(
+        zip(
+            column_values("Friendly Name"),
+            table.column("Current Entity ID").to_pylist(),
+            column_values("New Entity ID"),
+        )
+    )
+
+
+def read_input_file(input_filename, use_pyarrow=False):
+    # Use pyarrow's columnar CSV reader when asked to, or for large files if it
+    # is installed
+    if use_pyarrow or os.path.getsize(input_filename) > PYARROW_MIN_FILE_SIZE:
+        try:
+            return read_input_file_pyarrow(input_filename)
+        except ImportError:
+            if use_pyarrow:
+                raise
+
+    rename_data = []
+    with open(input_filename, mode="r", buffering=1 << 20, newline="") as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            entity_id = row["Current Entity ID"]
+            friendly_name = row.get(
+                "Friendly Name", ""
+            )  # Check if 'Friendly Name' is present
+            new_entity_id = row.get(
+                "New Entity ID", ""
+            )  # Check if 'New Entity ID' is present
+            rename_data.append((friendly_name, entity_id, new_entity_id))
+    return rename_data
+
+
 def process_entities(
-    entity_data, search_regex, replace_regex=None, output_file=None, input_filename=None
+    entity_data,
+    search_pattern,
+    replace_regex=None,
+    output_file=None,
+    input_filename=None,
+    no_print=False,
+    assume_yes=False,
+    use_pyarrow=False,
 ):
-    rename_data = []
     if input_filename:
         # Read data from the input file
-        with open(input_filename, mode="r") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                entity_id = row["Current Entity ID"]
-                friendly_name = row.get(
-                    "Friendly Name", ""
-                )  # Check if 'Friendly Name' is present
-                new_entity_id = row.get(
-                    "New Entity ID", ""
-                )  # Check if 'New Entity ID' is present
-                rename_data.append((friendly_name, entity_id, new_entity_id))
+        rename_data = read_input_file(input_filename, use_pyarrow)
 
         if not rename_data:
             print("No data found in the input file.")
@@ -120,93 +211,164 @@ def process_entities(
 
     else:
         if replace_regex:
-            for friendly_name, entity_id in entity_data:
-                new_entity_id = re.sub(search_regex, replace_regex, entity_id)
-                rename_data.append((friendly_name, entity_id, new_entity_id))
+            sub = search_pattern.sub
+            rename_data = [
+                (friendly_name, entity_id, sub(replace_regex, entity_id))
+                for friendly_name, entity_id in entity_data
+            ]
         else:
             rename_data = [
                 (friendly_name, entity_id, "")
                 for friendly_name, entity_id in entity_data
             ]
 
-    # Print the table with friendly name and entity ID
-    table = [("Friendly Name", "Current Entity ID", "New Entity ID")] + align_strings(
-        rename_data
-    )
-    print(tabulate.tabulate(table, headers="firstrow", tablefmt="github"))
+    # Confirmation is asked for if replace_regex is provided or if reading from
+    # input file, unless assume_yes is set
+    renaming = replace_regex or input_filename
+    confirm = renaming and not assume_yes
+
+    # Print the table with friendly name and entity ID, unless it was disabled.
+    # Large tables are not printed when they are written to the CSV file and
+    # no confirmation is asked for, so the user always sees what they confirm
+    too_large = output_file and len(rename_data) > PRINT_ROW_LIMIT
+    if no_print or (too_large and not confirm):
+        print(f"(Table of {len(rename_data)} entities not printed)")
+    else:
+        print(format_table(TABLE_HEADER, align_strings(rename_data)))
+
+    # Ask user for confirmation
+    if confirm:
+        answer = input("\nDo you want to proceed with renaming the entities? (y/N): ")
+        if answer.lower() not in ["y", "yes"]:
+            print("Renaming process aborted.")
+            return
 
     # Write to CSV file if output file is provided
-    table = [("Friendly Name", "Current Entity ID", "New Entity ID")] + rename_data
     if output_file:
-        write_to_csv(table, output_file)
+        write_to_csv(TABLE_HEADER, rename_data, output_file)
 
-    # Ask user for confirmation if replace_regex is provided or if reading from input file
-    if not replace_regex and not input_filename:
-        return
+    if renaming:
+        asyncio.run(rename_entities(rename_data))
 
-    answer = input("\nDo you want to proceed with renaming the entities? (y/N): ")
-    if answer.lower() not in ["y", "yes"]:
-        print("Renaming process aborted.")
-        return
 
-    asyncio.run(rename_entities(rename_data))
+def build_payloads(rename_data):
+    # Serialize the update messages for all entities up front so sending
+    # them is pure I/O
+    payloads = []
+    for index, (friendly_name, entity_id, new_entity_id) in enumerate(
+        rename_data, start=1
+    ):
+        entity_registry_update_msg = {
+            "id": index,
+            "type": "config/entity_registry/update",
+            "entity_id": entity_id,
+        }
+        if new_entity_id:
+            entity_registry_update_msg["new_entity_id"] = new_entity_id
+        if friendly_name:
+            entity_registry_update_msg["name"] = friendly_name
+        payloads.append(orjson.dumps(entity_registry_update_msg).decode())
+    return payloads
 
 
-async def rename_entities(rename_data):
+async def send_all(websocket, payloads):
+    for payload in payloads:
+        await websocket.send(payload)
+        # print(f">>> {payload}")
 
-    ha_url = f"ws{TLS_S}://{config.HOST}/api/websocket"
-    auth_msg = json.dumps({"type": "auth", "access_token": config.ACCESS_TOKEN})
 
-    async with websockets.connect(ha_url) as websocket:
+async def recv_all(websocket, results, count):
+    # Home Assistant tags each result with the id of its request, so the
+    # results can be collected in whatever order they arrive. They are stored
+    # in the caller's dict so the ones received survive a dropped connection
+    while len(results) < count:
+        ws_update_result = await websocket.recv()
+        # print(f"<<< {ws_update_result}")
 
-        auth_request = await websocket.recv()
-        # print(f"<<< {auth_request}")
+        update_result = orjson.loads(ws_update_result)
+        if update_result.get("type") == "result":
+            results[update_result["id"]] = update_result
 
-        await websocket.send(auth_msg)
-        # print(f">>> {auth_msg}")
 
-        auth_result = await websocket.recv()
-        # print(f"<<< {auth_result}")
+async def authenticate(websocket, auth_msg):
+    auth_request = await websocket.recv()
+    # print(f"<<< {auth_request}")
+
+    await websocket.send(auth_msg)
+    # print(f">>> {auth_msg}")
+
+    auth_result = await websocket.recv()
+    # print(f"<<< {auth_result}")
+
+
+async def rename_entities(rename_data):
+
+    ha_url = f"ws{TLS_S}://{config.HOST}/api/websocket"
+    auth_msg = orjson.dumps(
+        {"type": "auth", "access_token": config.ACCESS_TOKEN}
+    ).decode()
+
+    # Serialize the payloads in a worker thread while connecting and
+    # authenticating
+    payloads_task = asyncio.create_task(asyncio.to_thread(build_payloads, rename_data))
+
+    results = {}
+    try:
+        # Result frames are tiny, so skip per-message deflate and allow larger
+        # write buffers for the pipelined updates
+        async with websockets.connect(
+            ha_url,
+            compression=None,
+            max_size=2**20,
+            ping_interval=None,
+            write_limit=2**20,
+        ) as websocket:
+
+            payloads, _ = await asyncio.gather(
+                payloads_task, authenticate(websocket, auth_msg)
+            )
 
-        # Rename the entities
-        for index, (friendly_name, entity_id, new_entity_id) in enumerate(
-            rename_data, start=1
-        ):
-            entity_registry_update_msg = {
-                "id": index,
-                "type": "config/entity_registry/update",
-                "entity_id": entity_id,
-            }
+            # Send all updates back-to-back and collect the results concurrently
+            await asyncio.gather(
+                send_all(websocket, payloads),
+                recv_all(websocket, results, len(payloads)),
+            )
+    finally:
+        # Report the results received so far even if the connection dropped
+        report_results(rename_data, results)
+
+
+def report_results(rename_data, results):
+    # Report the results in the original order, writing them out in one go
+    report = []
+    for index, (friendly_name, entity_id, new_entity_id) in enumerate(
+        rename_data, start=1
+    ):
+        update_result = results.get(index)
+        if update_result is None:
+            continue
+        if update_result.get("success"):
+            success_msg = f"Entity '{entity_id}'"
             if new_entity_id:
-                entity_registry_update_msg["new_entity_id"] = new_entity_id
+                success_msg += f" renamed to '{new_entity_id}'"
             if friendly_name:
-                entity_registry_update_msg["name"] = friendly_name
-
-            await websocket.send(json.dumps(entity_registry_update_msg))
-            # print(f">>> {entity_registry_update_msg}")
-
-            ws_update_result = await websocket.recv()
-            # print(f"<<< {ws_update_result}")
-
-            update_result = json.loads(ws_update_result)
-            if update_result.get("success"):
-                success_msg = f"Entity '{entity_id}'"
-                if new_entity_id:
-                    success_msg += f" renamed to '{new_entity_id}'"
-                if friendly_name:
-                    success_msg += f" with friendly name '{friendly_name}'"
-                success_msg += " successfully!"
-                print(success_msg)
-            else:
-                print(
-                    f"Failed to update entity '{entity_id}': {update_result.get('error', {}).get('message', 'Unknown error')}"
-                )
-
-
-def write_to_csv(table, filename):
+                success_msg += f" with friendly name '{friendly_name}'"
+            success_msg += " successfully!"
+            report.append(success_msg)
+        else:
+            report.append(
+                f"Failed to update entity '{entity_id}': {update_result.get('error', {}).get('message', 'Unknown error')}"
+            )
+    if missing := len(rename_data) - len(report):
+        report.append(f"No result received for {missing} entities.")
+    print("\n".join(report))
+
+
+def write_to_csv(header, rows, filename):
     with open(filename, mode="w", newline="") as file:
         writer = csv.writer(file)
-        writer.writerows(table)
+        writer.writerow(header)
+        writer.writerows(rows)
         print(f"(Table written to {filename})")
 
 
@@ -217,6 +379,12 @@ def main():
         dest="input_file",
         help="Input CSV file containing Friendly Name, Current Entity ID, and New Entity ID",
     )
+    parser.add_argument(
+        "--pyarrow",
+        dest="use_pyarrow",
+        action="store_true",
+        help="Read the input CSV file with pyarrow (used automatically for files over 10 MiB if installed)",
+    )
     parser.add_argument(
         "--search",
         dest="search_regex",
@@ -230,6 +398,18 @@ def main():
         dest="output_file",
         help="Output CSV file to export the results",
     )
+    parser.add_argument(
+        "--no-print",
+        dest="no_print",
+        action="store_true",
+        help="Do not print the table of entities",
+    )
+    parser.add_argument(
+        "--yes",
+        dest="assume_yes",
+        action="store_true",
+        help="Rename the entities without asking for confirmation",
+    )
     args = parser.parse_args()
 
     # Validate argument combinations
@@ -239,10 +419,27 @@ def main():
     elif args.replace_regex and not args.search_regex:
         print("Error: --replace requires --search.")
         return
+    elif args.use_pyarrow and not args.input_file:
+        print("Error: --pyarrow requires --input-file.")
+        return
+    elif args.use_pyarrow and importlib.util.find_spec("pyarrow") is None:
+        print("Error: --pyarrow requires the pyarrow package to be installed.")
+        return
     if args.search_regex:
-        if entity_data := list_entities(args.search_regex):
+        try:
+            search_pattern = re.compile(args.search_regex)
+        except re.error as e:
+            print(f"Error: invalid --search regex: {e}")
+            return
+
+        if entity_data := list_entities(search_pattern):
             process_entities(
-                entity_data, args.search_regex, args.replace_regex, args.output_file
+                entity_data,
+                search_pattern,
+                args.replace_regex,
+                args.output_file,
+                no_print=args.no_print,
+                assume_yes=args.assume_yes,
             )
         else:
             print("No entities found matching the search regex.")
@@ -250,7 +447,16 @@ def main():
         input_file = args.input_file
         output_file = args.output_file
 
-        process_entities([], None, None, output_file, input_file)
+        process_entities(
+            [],
+            None,
+            None,
+            output_file,
+            input_file,
+            no_print=args.no_print,
+            assume_yes=args.assume_yes,
+            use_pyarrow=args.use_pyarrow,
+        )
     else:
         parser.print_help()
 